@@ -3,8 +3,24 @@ import pandas as pd
 import re
 import io
 import os
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
 from mistral_server import query_mistral  # type: ignore
 
+# Prefer the Rust-backed calamine reader; fall back to openpyxl if it's missing
+try:
+    import python_calamine  # type: ignore  # noqa: F401
+    READ_ENGINE = 'calamine'
+except ImportError:
+    READ_ENGINE = 'openpyxl'
+
+# RapidFuzz gives typo-tolerant suggestions and search
+from rapidfuzz import fuzz, process  # type: ignore
+
 # --------------------- Page Settings ---------------------
 st.set_page_config(page_title="Breakdown Chatbot", layout="centered")
 st.title("Breakdown Chatbot")
@@ -55,18 +71,97 @@ if not os.path.exists(EXCEL_PATH):
     st.error("❌ Excel file not found in the app directory.")
     st.stop()
 
-try:
-    df = pd.read_excel(EXCEL_PATH, engine='openpyxl')
+def read_workbook(path):
+    df = pd.read_excel(path, engine=READ_ENGINE)
     df = df.loc[:, ~df.columns.str.contains('^Unnamed')]
     df.columns = df.columns.str.strip()
-    st.success("✅ Data loaded from backend Excel file.")
+    return df
+
+@st.cache_data(show_spinner=False, max_entries=3)
+def load_df(path, mtime):
+    # mtime is only part of the cache key, so saving the file invalidates it;
+    # max_entries keeps frames for old mtimes from piling up in memory
+    return read_workbook(path)
+
+# One worker, so background saves to the workbook never overlap
+@st.cache_resource
+def excel_writer():
+    return ThreadPoolExecutor(max_workers=1)
+
+try:
+    # Rows added in this session go straight into st.session_state.df and are
+    # saved in the background; once those saves finish, adopt the new mtime
+    # so our own writes don't trigger a re-parse of the file. If another
+    # session wrote in between, the file has rows our df lacks, so reload.
+    save_failed = False
+    flushes = st.session_state.get("pending_flushes", [])
+    if flushes and not all(f.done() for f in flushes):
+        st.info("⏳ Saving the new row to the Excel file…")
+    elif flushes:
+        st.session_state.pending_flushes = []
+        try:
+            for f in flushes:
+                _, mtime_before, mtime_after = f.result()
+                if mtime_before != st.session_state.df_mtime:
+                    st.session_state.df_mtime = None
+                    break
+                st.session_state.df_mtime = mtime_after
+            st.success("✅ New row saved to the Excel file.")
+        except Exception as e:
+            st.error(f"❗ The new row was NOT saved to the Excel file and has been discarded: {e}")
+            st.session_state.df_mtime = None
+            save_failed = True
+
+    # Read after resolving the saves above, so a save finishing in between
+    # can't leave excel_mtime older than the adopted df_mtime
+    excel_mtime = os.path.getmtime(EXCEL_PATH)
+    if "df" not in st.session_state or (
+        not st.session_state.get("pending_flushes") and st.session_state.df_mtime != excel_mtime
+    ):
+        st.session_state.df = load_df(EXCEL_PATH, excel_mtime)
+        st.session_state.df_mtime = excel_mtime
+        st.session_state.df_version = None
+    df = st.session_state.df
+    if not save_failed:
+        st.success("✅ Data loaded from backend Excel file.")
 except Exception as e:
     st.error(f"❗ Error reading Excel file: {e}")
     st.stop()
 
 # --------------------- Normalize Function ---------------------
+# ASCII bytes that normalize() strips: everything except lowercase letters and digits
+_ASCII_DELETE = bytes(i for i in range(128) if not (chr(i).islower() or chr(i).isdigit()))
+
+@lru_cache(maxsize=100_000)
 def normalize(text):
-    return re.sub(r'[^a-zA-Z0-9]', '', str(text).lower())
+    text = str(text).lower()
+    if text.isascii():
+        return text.encode('ascii').translate(None, _ASCII_DELETE).decode('ascii')
+    return re.sub(r'[^a-z0-9]', '', text)
+
+# Same normalization as normalize(), applied to a whole Series in one pass:
+# delete ASCII non-alphanumerics, then drop whatever non-ASCII is left
+_NORM_TABLE = str.maketrans('', '', _ASCII_DELETE.decode('ascii'))
+
+def normalize_series(s):
+    return (
+        s.str.lower().str.translate(_NORM_TABLE)
+        .str.encode('ascii', errors='ignore').str.decode('ascii')
+    )
+
+# Normalized Machine Name / Problem columns, aligned with df, used for searching.
+# _df is not hashed (leading underscore); the file mtime plus the session's
+# df_version (None until rows are added in memory) identify it.
+@st.cache_data(show_spinner=False, max_entries=20)
+def build_search_index(_df, mtime, version):
+    def norm_col(col):
+        return normalize_series(_df[col].fillna('').astype(str))
+
+    index = pd.DataFrame({'_mn_norm': norm_col('Machine Name'), '_p_norm': norm_col('Problem')})
+    index['_c_norm'] = index['_p_norm'] + 'by' + index['_mn_norm']
+    return index
+
+search_index = build_search_index(df, st.session_state.df_mtime, st.session_state.df_version)
 
 # --------------------- Session State Setup ---------------------
 if "query" not in st.session_state:
@@ -85,25 +180,61 @@ if query_input != st.session_state.get("last_query", ""):
     st.session_state.query = query_input
     st.session_state.last_query = query_input
 
+# Queries shorter than this (after normalizing) skip suggestions and search
+MIN_QUERY_LEN = 3
+
+# Queries shorter than this only match exactly; longer ones tolerate
+# about one and a half edits, with the cutoff kept between 80 and 90
+MIN_FUZZY_LEN = 7
+
+def fuzzy_cutoff(norm_query):
+    if len(norm_query) < MIN_FUZZY_LEN:
+        return 100
+    return max(80, min(90, 100 - 150 / len(norm_query)))
+
+# Choices are already normalized, so no processor is needed per call
+def fuzzy_matches(norm_query, choices, limit):
+    # partial_ratio scores a choice found inside the query as 100, so only
+    # consider choices at least as long as the query (this also skips blanks)
+    eligible = choices[choices.str.len() >= len(norm_query)]
+    results = process.extract(
+        norm_query, eligible, scorer=fuzz.partial_ratio,
+        processor=None, limit=limit, score_cutoff=fuzzy_cutoff(norm_query)
+    )
+    return [key for _, _, key in results]
+
 # Build suggestions: show unique Machine Names AND unique (Problem + Machine Name) pairs
-all_suggestions = []
+@st.cache_data(show_spinner=False, max_entries=20)
+def build_suggestions(_df, mtime, version):
+    all_suggestions = []
 
-# Add Machine Name suggestions
-machine_names = df['Machine Name'].dropna().astype(str).unique()
-all_suggestions.extend(machine_names)
+    # Add Machine Name suggestions
+    machine_names = _df['Machine Name'].dropna().astype(str).unique()
+    all_suggestions.extend(machine_names)
 
-# Add Problem by Machine Name suggestions
-problem_rows = df[['Problem', 'Machine Name']].dropna()
-problem_rows = problem_rows.astype(str).drop_duplicates()
-problem_suggestions = [
-    f"{row['Problem']} by {row['Machine Name']}" for _, row in problem_rows.iterrows()
-]
-all_suggestions.extend(problem_suggestions)
+    # Add Problem by Machine Name suggestions
+    problem_rows = _df[['Problem', 'Machine Name']].dropna()
+    problem_rows = problem_rows.astype(str).drop_duplicates()
+    problem_suggestions = (
+        problem_rows['Problem'] + ' by ' + problem_rows['Machine Name']
+    ).drop_duplicates().tolist()
+    all_suggestions.extend(problem_suggestions)
+
+    # Keep both forms as Series, aligned by index
+    all_suggestions = pd.Series(all_suggestions, dtype=object)
+    suggestions_norm = normalize_series(all_suggestions)
+    return all_suggestions, suggestions_norm
+
+all_suggestions, suggestions_norm = build_suggestions(
+    df, st.session_state.df_mtime, st.session_state.df_version
+)
 
 matches = []
-if st.session_state.query:
-    norm_query = normalize(st.session_state.query)
-    matches = [s for s in all_suggestions if norm_query in normalize(s)]
+norm_query = normalize(st.session_state.query)
+if st.session_state.query and len(norm_query) < MIN_QUERY_LEN:
+    st.caption(f"Type {MIN_QUERY_LEN}+ characters to see suggestions and results.")
+elif st.session_state.query:
+    matches = all_suggestions[fuzzy_matches(norm_query, suggestions_norm, 10)].tolist()
 
 if matches:
     st.markdown("### 💡 Suggestions (click to auto-fill):")
@@ -114,44 +245,92 @@ if matches:
             st.rerun()
 
 # --------------------- Search & Mistral Explanation ---------------------
-if st.session_state.query:
-    norm_final = normalize(st.session_state.query)
-    matched_rows = []
+PROMPT_MAX_ROWS = 50
+LLM_CACHE_TTL = 3600
+LLM_CACHE_MAX_ENTRIES = 100
+
+# Finished responses keyed on prompt, shared across reruns and sessions.
+# Misses are streamed live and stored once complete.
+@st.cache_resource
+def llm_response_cache():
+    return OrderedDict(), threading.Lock()
+
+def get_cached_response(prompt):
+    cache, lock = llm_response_cache()
+    with lock:
+        entry = cache.get(prompt)
+        if entry and time.time() - entry[0] < LLM_CACHE_TTL:
+            return entry[1]
+    return None
 
-    for _, row in df.iterrows():
-        machine_norm = normalize(str(row.get('Machine Name', '')))
-        problem_norm = normalize(str(row.get('Problem', '')))
-        combined_norm = normalize(f"{row.get('Problem', '')} by {row.get('Machine Name', '')}")
+def store_response(prompt, response):
+    cache, lock = llm_response_cache()
+    now = time.time()
+    with lock:
+        # Oldest entries come first, so expired ones are at the front
+        while cache and now - next(iter(cache.values()))[0] >= LLM_CACHE_TTL:
+            cache.popitem(last=False)
+        cache.pop(prompt, None)
+        cache[prompt] = (now, response)
+        while len(cache) > LLM_CACHE_MAX_ENTRIES:
+            cache.popitem(last=False)
 
-        if norm_final in machine_norm or norm_final in problem_norm or norm_final in combined_norm:
-            matched_rows.append(row)
+if st.session_state.query and len(norm_query) >= MIN_QUERY_LEN:
+    norm_final = norm_query
+    mask = (
+        search_index['_mn_norm'].str.contains(norm_final, regex=False)
+        | search_index['_p_norm'].str.contains(norm_final, regex=False)
+        | search_index['_c_norm'].str.contains(norm_final, regex=False)
+    )
+    results_title = "Matching Results"
+
+    # No exact hit: fall back to the same fuzzy matching the suggestions use
+    if not mask.any():
+        # Score the two fields separately; the combined key would let blank
+        # rows (just 'by') match any query containing "by"
+        fuzzy_hits = (
+            fuzzy_matches(norm_final, search_index['_mn_norm'], None)
+            + fuzzy_matches(norm_final, search_index['_p_norm'], None)
+        )
+        mask = search_index.index.isin(fuzzy_hits)
+        results_title = "Closest Matches"
 
-    if matched_rows:
-        df_result = pd.DataFrame(matched_rows).reset_index(drop=True)
-        st.markdown(f"### 🔍 Matching Results ({len(df_result)} found):")
+    if mask.any():
+        df_result = df.loc[mask].reset_index(drop=True)
+        st.markdown(f"### 🔍 {results_title} ({len(df_result)} found):")
         st.dataframe(df_result)
 
+        # Cap the rows sent to the model and use CSV, which is compact and fast to build
+        sample = df_result.head(PROMPT_MAX_ROWS)
+        details = sample.to_csv(index=False)
+        if len(sample) < len(df_result):
+            details = f"(showing first {len(sample)} of {len(df_result)} rows)\n{details}"
+
         if len(df_result) == 1:
             user_prompt = (
                 f"Here is the data for query: '{st.session_state.query}'. "
-                f"Explain the details and any insights.\n\n{df_result.to_string(index=False)}"
+                f"Explain the details and any insights.\n\n{details}"
             )
         else:
             problem_counts = df_result['Problem'].value_counts().reset_index()
             problem_counts.columns = ['Problem', 'Count']
-            summary = problem_counts.to_string(index=False)
+            summary = problem_counts.to_csv(index=False)
 
             user_prompt = (
                 f"The query '{st.session_state.query}' matches {len(df_result)} rows. "
                 f"Analyze the problems, starting with the most common one. "
                 f"Provide possible causes, suggestions, and order them by frequency.\n\n"
                 f"Problem summary:\n{summary}\n\n"
-                f"Details of matches:\n{df_result.to_string(index=False)}"
+                f"Details of matches:\n{details}"
             )
 
-        response = query_mistral(user_prompt)
         st.markdown("### 🧠 Explanation & Suggestions:")
-        st.info(response)
+        cached = get_cached_response(user_prompt)
+        if cached is not None:
+            st.markdown(cached)
+        else:
+            response = st.write_stream(query_mistral(user_prompt))
+            store_response(user_prompt, response)
     else:
         st.warning("❌ No matches found.")
 
@@ -159,54 +338,131 @@ if st.session_state.query:
 st.markdown("---")
 st.subheader("✍️ Manually Add New Data Entry (Real-time)")
 
+def save_df_to_excel(path, df):
+    # Serialize once; the same bytes go to disk and to the download button
+    buffer = io.BytesIO()
+    df.to_excel(buffer, index=False, engine='openpyxl')
+    data = buffer.getvalue()
+
+    # Replace the file in one step so readers never see a half-written workbook
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return data
+
+def flush_row(path, df, new_row_df, expected_mtime):
+    # The mtime before writing tells the session whether anyone else saved
+    # since its df was loaded; if so, add the row to the file's current
+    # contents instead of overwriting their rows with ours
+    mtime_before = os.path.getmtime(path)
+    if mtime_before != expected_mtime:
+        df = pd.concat([read_workbook(path), new_row_df], ignore_index=True)
+    data = save_df_to_excel(path, df)
+    return data, mtime_before, os.path.getmtime(path)
+
+# Accepted date formats for manual entry, day before month
+DATE_FORMATS = ("%d/%m/%Y", "%d-%m-%Y", "%d.%m.%Y", "%Y-%m-%d")
+
+def parse_date(value):
+    for fmt in DATE_FORMATS:
+        try:
+            return pd.to_datetime(value, format=fmt)
+        except ValueError:
+            pass
+    raise ValueError(f"unrecognized date: {value}")
+
+def coerce_row(row, dtypes):
+    # Convert editor strings to the df's column types ("" -> NA), so adding a
+    # row doesn't turn numeric/date columns into object columns. Returns the
+    # one-row frame and the columns whose values couldn't be parsed.
+    columns, bad_columns = {}, []
+    for col, dtype in dtypes.items():
+        value = row.get(col)
+        if isinstance(value, str):
+            value = value.strip()
+        is_numeric = pd.api.types.is_numeric_dtype(dtype)
+        is_datetime = pd.api.types.is_datetime64_any_dtype(dtype)
+        try:
+            if value is None or value == "":
+                value = None
+            elif is_numeric:
+                value = pd.to_numeric(value)
+            elif is_datetime:
+                value = parse_date(value)
+        except (ValueError, TypeError):
+            bad_columns.append(col)
+            continue
+
+        values = pd.Series([value])
+        if is_numeric:
+            values = pd.to_numeric(values)
+        elif is_datetime:
+            values = pd.to_datetime(values)
+        else:
+            values = values.astype(dtype)
+        columns[col] = values
+    return pd.DataFrame(columns), bad_columns
+
+def flushed_bytes(future):
+    return future.result()[0]
+
 if "manual_inputs" not in st.session_state:
     st.session_state.manual_inputs = {col: "" for col in df.columns}
 if "confirm_add" not in st.session_state:
     st.session_state.confirm_add = False
-if "form_cleared" not in st.session_state:
-    st.session_state.form_cleared = False
+# Bumping this gives the editor a new key, which resets it to an empty row
+if "editor_version" not in st.session_state:
+    st.session_state.editor_version = 0
 
 with st.form("manual_entry_form"):
-    for col in df.columns:
-        key = f"input_{col.replace(' ', '_')}"
-        if key not in st.session_state or st.session_state.form_cleared:
-            st.session_state[key] = ""
-        st.session_state.manual_inputs[col] = st.text_input(
-            f"Enter value for **{col}**",
-            value=st.session_state[key],
-            key=key
-        )
-    st.session_state.form_cleared = False
+    new_row = st.data_editor(
+        pd.DataFrame([{col: "" for col in df.columns}]),
+        num_rows="fixed",
+        hide_index=True,
+        key=f"new_row_{st.session_state.editor_version}"
+    )
     confirm = st.form_submit_button("➕ Add Row")
 
 if confirm:
-    st.session_state.confirm_add = True
+    st.session_state.manual_inputs = new_row.iloc[0].to_dict()
+    new_row_df, bad_columns = coerce_row(st.session_state.manual_inputs, df.dtypes)
+    if bad_columns:
+        st.error(
+            f"❗ Couldn't read the value for: {', '.join(bad_columns)}. "
+            "Use plain numbers (e.g. 1.5) and dates as DD/MM/YYYY."
+        )
+        st.session_state.confirm_add = False
+    else:
+        st.session_state.new_row_df = new_row_df
+        st.session_state.confirm_add = True
 
 if st.session_state.confirm_add:
     st.warning("Are you sure you want to add this row?")
     col1, col2 = st.columns([1, 1])
     with col1:
         if st.button("✅ Yes, Add"):
-            df = pd.concat([df, pd.DataFrame([st.session_state.manual_inputs])], ignore_index=True)
-            df.to_excel(EXCEL_PATH, index=False, engine='openpyxl')
-            st.success("✅ Row added successfully!")
+            new_row_df = st.session_state.new_row_df
+            df = pd.concat([df, new_row_df], ignore_index=True)
+            st.session_state.df = df
+            st.session_state.df_version = uuid.uuid4().hex
+            future = excel_writer().submit(
+                flush_row, EXCEL_PATH, df, new_row_df, st.session_state.df_mtime
+            )
+            st.session_state.pending_flushes = st.session_state.get("pending_flushes", []) + [future]
+            st.info("⏳ Row added, saving to the Excel file in the background…")
             st.markdown("### 📌 Updated Data (last 5 rows):")
             st.dataframe(df.tail(5))
 
-            buffer = io.BytesIO()
-            df.to_excel(buffer, index=False, engine='openpyxl')
-            buffer.seek(0)
+            # Bytes are taken from the background save when the button is clicked
             st.download_button(
                 label="📥 Download Updated Excel",
-                data=buffer,
+                data=partial(flushed_bytes, future),
                 file_name="updated_data.xlsx",
                 mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
             )
 
-            for col in df.columns:
-                key = f"input_{col.replace(' ', '_')}"
-                if key in st.session_state:
-                    del st.session_state[key]
+            st.session_state.editor_version += 1
             st.session_state.manual_inputs = {col: "" for col in df.columns}
             st.session_state.confirm_add = False
 
@@ -215,10 +471,6 @@ if st.session_state.confirm_add:
             st.session_state.confirm_add = False
 
 if st.button("🧹 Clear Form"):
-    for col in df.columns:
-        key = f"input_{col.replace(' ', '_')}"
-        if key in st.session_state:
-            del st.session_state[key]
+    st.session_state.editor_version += 1
     st.session_state.manual_inputs = {col: "" for col in df.columns}
-    st.session_state.form_cleared = True
     st.rerun()
@@ -1,11 +1,23 @@
+import json
 import requests
 
+# Reused across calls so the connection to Ollama is kept alive
+_SESSION = requests.Session()
+
 def query_mistral(prompt):
+    # Yields the response text chunk by chunk as Ollama generates it
     url = "http://localhost:11434/api/generate"
     data = {
         "model": "mistral",
         "prompt": prompt,
-        "stream": False
+        "stream": True
     }
-    response = requests.post(url, json=data)
-    return response.json()["response"]
+    with _SESSION.post(url, json=data, stream=True, timeout=600) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if not line:
+                continue
+            chunk = json.loads(line)
+            yield chunk.get("response", "")
+            if chunk.get("done"):
+                break